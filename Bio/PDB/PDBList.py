@@ -36,17 +36,63 @@
 """Access the PDB over the internet (e.g. to download structures)."""
 
 
+import collections
 import contextlib
 import ftplib
-import gzip
+import http.client
 import os
 import re
 import shutil
 import sys
+import threading
+import zlib
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from urllib.request import urlopen
-from urllib.request import urlretrieve
-from urllib.request import urlcleanup
+
+# Errors from a failed or corrupt transfer, reported as a failed download
+_DOWNLOAD_ERRORS = (OSError, EOFError, zlib.error, http.client.IncompleteRead)
+
+try:
+    # ISA-L's igzip is a faster drop-in replacement for gzip, use it if present
+    from isal import igzip as _gzip
+    from isal import isal_zlib
+
+    _DOWNLOAD_ERRORS += (isal_zlib.error,)
+except ImportError:
+    import gzip as _gzip
+
+# Number of items queued per download thread by the bulk download methods
+_PENDING_PER_WORKER = 4
+
+# Chunk size used when writing downloaded (decompressed) data to disk
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Remote (compressed) file names of the structures, for each file format
+_ARCHIVE_FILE_NAMES = {
+    "pdb": "pdb%s.ent.gz",
+    "mmCif": "%s.cif.gz",
+    "xml": "%s.xml.gz",
+    "mmtf": "%s",
+    "bundle": "%s-pdb-bundle.tar.gz",
+}
+
+# Directories of the file formats stored in the divided/obsolete trees
+_DIVIDED_FILE_TYPES = {"pdb": "pdb", "mmCif": "mmCIF", "xml": "XML"}
+
+# Local (uncompressed) file names of the structures, for each file format
+_FINAL_FILE_NAMES = {
+    "pdb": "pdb%s.ent",
+    "mmCif": "%s.cif",
+    "xml": "%s.xml",
+    "mmtf": "%s.mmtf",
+    "bundle": "%s-pdb-bundle.tar",
+}
+
+# File names of the biological assemblies, as listed on the FTP server
+_re_mmcif_assembly = re.compile(r"(\d[0-9a-z]{3})-assembly(\d+).cif.gz")
+_re_pdb_assembly = re.compile(r"(\d[0-9a-z]{3}).pdb(\d+).gz")
 
 
 class PDBList:
@@ -75,6 +121,10 @@ class PDBList:
     the proxy variable to your environment, e.g. in Unix:
     export HTTP_PROXY='http://realproxy.charite.de:888'
     (This can also be added to ~/.bashrc)
+
+    The bulk download methods (e.g. download_pdb_files or download_entire_pdb)
+    fetch several files at once, up to the max_workers argument (default 8).
+    A file which fails to download is reported and does not stop the others.
     """
 
     PDB_REF = """
@@ -85,12 +135,20 @@ class PDBList:
     """
 
     def __init__(
-        self, server="ftp://ftp.wwpdb.org", pdb=None, obsolete_pdb=None, verbose=True
+        self,
+        server="ftp://ftp.wwpdb.org",
+        pdb=None,
+        obsolete_pdb=None,
+        verbose=True,
+        max_workers=8,
     ):
         """Initialize the class with the default server or a custom one.
 
         Argument pdb is the local path to use, defaulting to the current
         directory at the moment of initialisation.
+
+        Argument max_workers is the number of files downloaded in parallel
+        by the bulk download methods (default 8).
         """
         self.pdb_server = server  # remote pdb server
         if pdb:
@@ -106,12 +164,14 @@ class PDBList:
             self.obsolete_pdb = obsolete_pdb
         else:
             self.obsolete_pdb = os.path.join(self.local_pdb, "obsolete")
-            if not os.access(self.obsolete_pdb, os.F_OK):
-                os.makedirs(self.obsolete_pdb)
+            os.makedirs(self.obsolete_pdb, exist_ok=True)
 
         # variable for command-line option
         self.flat_tree = False
 
+        # number of files downloaded in parallel by the bulk download methods
+        self.max_workers = max_workers
+
     @staticmethod
     def _print_default_format_warning(file_format):
         """Print a warning to stdout (PRIVATE).
@@ -126,6 +186,92 @@ class PDBList:
             return "mmCif"
         return file_format
 
+    @staticmethod
+    def _check_file_format(file_format):
+        """Raise a ValueError if file_format is not supported (PRIVATE)."""
+        if file_format not in _ARCHIVE_FILE_NAMES:
+            raise ValueError(
+                f"Specified file_format {file_format} doesn't exists or is not "
+                "supported. Maybe a typo. Please, use one of the following: "
+                "mmCif, pdb, xml, mmtf, bundle"
+            )
+
+    def _map_concurrently(self, function, items):
+        """Apply function to each item using a pool of threads (PRIVATE).
+
+        Downloads are limited by network latency rather than CPU, so running
+        several at once (up to max_workers) keeps the connection busy.
+        An error for one item is printed and does not stop the others.
+        At most a few items per thread are queued at any time. Returns a list
+        of the results, in the same order as the items, with None for the
+        items which failed.
+        """
+
+        def apply(item):
+            try:
+                return function(item)
+            except Exception as err:
+                print(f"error {item}: {err}\n")
+
+        # Submit the items as the downloads complete, rather than all at once,
+        # so that long lists (e.g. the entire PDB) do not create a future for
+        # every item up front
+        results = []
+        pending = collections.deque()
+        max_pending = self.max_workers * _PENDING_PER_WORKER
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for item in items:
+                if len(pending) >= max_pending:
+                    results.append(pending.popleft().result())
+                pending.append(executor.submit(apply, item))
+            results.extend(future.result() for future in pending)
+        return results
+
+    def _get_local_file_names(self):
+        """Return the set of file names present in the local PDB tree (PRIVATE).
+
+        Lists each two-letter directory once, which is much cheaper than
+        checking for every expected file individually on large trees.
+        """
+        if not os.path.isdir(self.local_pdb):
+            return set()
+        if self.flat_tree:
+            paths = [self.local_pdb]
+        else:
+            with os.scandir(self.local_pdb) as entries:
+                paths = [
+                    entry.path
+                    for entry in entries
+                    if len(entry.name) == 2 and entry.is_dir()
+                ]
+        names = set()
+        for path in paths:
+            with os.scandir(path) as entries:
+                names.update(entry.name for entry in entries)
+        return names
+
+    @staticmethod
+    def _download_gunzipped(url, filename):
+        """Download a gzip compressed file and save it uncompressed (PRIVATE).
+
+        The data is decompressed as it arrives, without a temporary .gz file,
+        into a temporary file next to filename which then replaces it. If the
+        transfer fails, only the temporary file is removed, so any existing
+        copy of filename is left untouched, and the error is re-raised. The
+        temporary name is unique per process and thread, so concurrent
+        downloads of the same file do not write into each other.
+        """
+        temp_filename = f"{filename}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            with contextlib.closing(urlopen(url)) as handle:
+                with _gzip.open(handle, "rb") as gz, open(temp_filename, "wb") as out:
+                    shutil.copyfileobj(gz, out, _COPY_BUFFER_SIZE)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
     @staticmethod
     def get_status_list(url):
         """Retrieve a list of pdb codes in the weekly pdb status file from given URL.
@@ -174,8 +320,9 @@ class PDBList:
         if self._verbose:
             print("Retrieving index file. Takes about 27 MB.")
         with contextlib.closing(urlopen(url)) as handle:
+            # Skip the two header lines, streaming rather than reading all lines
             all_entries = [
-                line[:4].decode() for line in handle.readlines()[2:] if len(line) > 4
+                line[:4].decode() for line in islice(handle, 2, None) if len(line) > 4
             ]
         return all_entries
 
@@ -265,42 +412,21 @@ class PDBList:
 
         # Get the compressed PDB structure
         code = pdb_code.lower()
-        archive = {
-            "pdb": "pdb%s.ent.gz",
-            "mmCif": "%s.cif.gz",
-            "xml": "%s.xml.gz",
-            "mmtf": "%s",
-            "bundle": "%s-pdb-bundle.tar.gz",
-        }
-        archive_fn = archive[file_format] % code
-
-        if file_format not in archive.keys():
-            raise (
-                "Specified file_format %s doesn't exists or is not supported. Maybe a "
-                "typo. Please, use one of the following: mmCif, pdb, xml, mmtf, bundle"
-                % file_format
-            )
+        short_code = code[1:3]
+        self._check_file_format(file_format)
+        archive_fn = _ARCHIVE_FILE_NAMES[file_format] % code
 
-        if file_format in ("pdb", "mmCif", "xml"):
+        if file_format in _DIVIDED_FILE_TYPES:
             pdb_dir = "divided" if not obsolete else "obsolete"
-            file_type = (
-                "pdb"
-                if file_format == "pdb"
-                else "mmCIF"
-                if file_format == "mmCif"
-                else "XML"
-            )
-            url = self.pdb_server + "/pub/pdb/data/structures/%s/%s/%s/%s" % (
-                pdb_dir,
-                file_type,
-                code[1:3],
-                archive_fn,
+            file_type = _DIVIDED_FILE_TYPES[file_format]
+            url = (
+                f"{self.pdb_server}/pub/pdb/data/structures/"
+                f"{pdb_dir}/{file_type}/{short_code}/{archive_fn}"
             )
         elif file_format == "bundle":
-            url = self.pdb_server + "/pub/pdb/compatible/pdb_bundle/%s/%s/%s" % (
-                code[1:3],
-                code,
-                archive_fn,
+            url = (
+                f"{self.pdb_server}/pub/pdb/compatible/pdb_bundle/"
+                f"{short_code}/{code}/{archive_fn}"
             )
         else:
             url = f"http://mmtf.rcsb.org/v1.0/full/{code}"
@@ -309,20 +435,11 @@ class PDBList:
         if pdir is None:
             path = self.local_pdb if not obsolete else self.obsolete_pdb
             if not self.flat_tree:  # Put in PDB-style directory tree
-                path = os.path.join(path, code[1:3])
+                path = os.path.join(path, short_code)
         else:  # Put in specified directory
             path = pdir
-        if not os.access(path, os.F_OK):
-            os.makedirs(path)
-        filename = os.path.join(path, archive_fn)
-        final = {
-            "pdb": "pdb%s.ent",
-            "mmCif": "%s.cif",
-            "xml": "%s.xml",
-            "mmtf": "%s.mmtf",
-            "bundle": "%s-pdb-bundle.tar",
-        }
-        final_file = os.path.join(path, final[file_format] % code)
+        os.makedirs(path, exist_ok=True)
+        final_file = os.path.join(path, _FINAL_FILE_NAMES[file_format] % code)
 
         # Skip download if the file already exists
         if not overwrite:
@@ -335,15 +452,9 @@ class PDBList:
         if self._verbose:
             print(f"Downloading PDB structure '{pdb_code}'...")
         try:
-            urlcleanup()
-            urlretrieve(url, filename)
-        except OSError:
+            self._download_gunzipped(url, final_file)
+        except _DOWNLOAD_ERRORS:
             print("Desired structure doesn't exist")
-        else:
-            with gzip.open(filename, "rb") as gz:
-                with open(final_file, "wb") as out:
-                    out.writelines(gz)
-            os.remove(filename)
         return final_file
 
     def update_pdb(self, file_format=None, with_assemblies=False):
@@ -353,6 +464,10 @@ class PDBList:
         It gets the weekly lists of new and modified pdb entries and
         automatically downloads the according PDB files.
         You can call this module as a weekly cron job.
+
+        With with_assemblies, the biological assemblies of these entries are
+        also downloaded. If the list of assemblies cannot be retrieved, the
+        error is printed and only the structures are updated.
         """
         assert os.path.isdir(self.local_pdb)
         assert os.path.isdir(self.obsolete_pdb)
@@ -362,24 +477,31 @@ class PDBList:
 
         new, modified, obsolete = self.get_recent_changes()
 
-        for pdb_code in new + modified:
+        if with_assemblies:
+            # Fetch the list once, rather than from each download thread, and
+            # index it by entry rather than scanning it for every entry
+            assemblies = {}
             try:
-                self.retrieve_pdb_file(pdb_code, file_format=file_format)
-                if with_assemblies:
-                    assemblies = self.get_all_assemblies(file_format)
-                    for a_pdb_code, assembly_num in assemblies:
-                        if a_pdb_code == pdb_code:
-                            pl.retrieve_assembly_file(
-                                pdb_code,
-                                assembly_num,
-                                file_format=file_format,
-                                overwrite=True,
-                            )
-
+                all_assemblies = self.get_all_assemblies(file_format)
             except Exception as err:
-                print(f"error {pdb_code}: {err}\n")
-                # you can insert here some more log notes that
-                # something has gone wrong.
+                # Still update the structures without their assemblies
+                print(f"error retrieving the list of assemblies: {err}\n")
+                all_assemblies = []
+            for a_pdb_code, assembly_num in all_assemblies:
+                assemblies.setdefault(a_pdb_code, []).append(assembly_num)
+
+        def update_entry(pdb_code):
+            self.retrieve_pdb_file(pdb_code, file_format=file_format)
+            if with_assemblies:
+                for assembly_num in assemblies.get(pdb_code, []):
+                    self.retrieve_assembly_file(
+                        pdb_code,
+                        assembly_num,
+                        file_format=file_format,
+                        overwrite=True,
+                    )
+
+        self._map_concurrently(update_entry, new + modified)
 
         # Move the obsolete files to a special folder
         # NOTE: This should be updated to handle multiple file types and
@@ -391,17 +513,17 @@ class PDBList:
                 old_file = os.path.join(self.local_pdb, f"pdb{pdb_code}.ent")
                 new_dir = self.obsolete_pdb
             else:
+                short_code = pdb_code[1:3]
                 old_file = os.path.join(
-                    self.local_pdb, pdb_code[1:3], f"pdb{pdb_code}.ent"
+                    self.local_pdb, short_code, f"pdb{pdb_code}.ent"
                 )
-                new_dir = os.path.join(self.obsolete_pdb, pdb_code[1:3])
+                new_dir = os.path.join(self.obsolete_pdb, short_code)
             new_file = os.path.join(new_dir, f"pdb{pdb_code}.ent")
             if os.path.isfile(old_file):
-                if not os.path.isdir(new_dir):
-                    os.mkdir(new_dir)
+                os.makedirs(new_dir, exist_ok=True)
                 try:
                     shutil.move(old_file, new_file)
-                except Exception:
+                except OSError:
                     print(f"Could not move {old_file} to obsolete folder")
             elif os.path.isfile(new_file):
                 if self._verbose:
@@ -415,7 +537,7 @@ class PDBList:
     ):
         """Fetch set of PDB structure files from the PDB server and stores them locally.
 
-        The PDB structure's file name is returned as a single string.
+        The files are downloaded in parallel, using up to max_workers threads.
         If obsolete ``==`` True, the files will be saved in a special file tree.
 
         :param pdb_codes: a list of 4-symbols structure Ids from PDB
@@ -446,18 +568,21 @@ class PDBList:
         :type pdir: string
 
         :return: filenames
-        :rtype: string
+        :rtype: list of strings
         """
         # Deprecation warning
         file_format = self._print_default_format_warning(file_format)
-        for pdb_code in pdb_codes:
-            self.retrieve_pdb_file(
+        self._check_file_format(file_format)
+        return self._map_concurrently(
+            lambda pdb_code: self.retrieve_pdb_file(
                 pdb_code,
                 obsolete=obsolete,
                 pdir=pdir,
                 file_format=file_format,
                 overwrite=overwrite,
-            )
+            ),
+            pdb_codes,
+        )
 
     def get_all_assemblies(self, file_format="mmCif"):
         """Retrieve the list of PDB entries with an associated bio assembly.
@@ -487,10 +612,10 @@ class PDBList:
 
         if file_format.lower() == "mmcif":
             ftp.cwd("/pub/pdb/data/assemblies/mmCIF/all/")
-            re_name = re.compile(r"(\d[0-9a-z]{3})-assembly(\d+).cif.gz")
+            re_name = _re_mmcif_assembly
         elif file_format.lower() == "pdb":
             ftp.cwd("/pub/pdb/data/biounit/PDB/all/")
-            re_name = re.compile(r"(\d[0-9a-z]{3}).pdb(\d+).gz")
+            re_name = _re_pdb_assembly
         else:
             msg = "file_format for assemblies must be 'pdb' or 'mmCif'"
             raise ValueError(msg)
@@ -507,14 +632,9 @@ class PDBList:
         all_assemblies = []
         for line in response:
             if line.endswith(".gz"):
-                match = re_name.findall(line)
-                try:
-                    if len(match):
-                        entry, assembly = match[0]
-                except ValueError:
-                    pass
-                else:
-                    all_assemblies.append((entry, assembly))
+                match = re_name.search(line)
+                if match:
+                    all_assemblies.append(match.groups())
         self.assemblies = all_assemblies  # cache
         return all_assemblies
 
@@ -538,21 +658,23 @@ class PDBList:
 
         file_format = self._print_default_format_warning(file_format)
         file_format = file_format.lower()  # we should standardize this.
-        if file_format not in archive:
-            raise (
-                "Specified file_format '%s' is not supported. Use one of the "
-                "following: 'mmcif' or 'pdb'." % file_format
-            )
+        try:
+            archive_template = archive[file_format]
+        except KeyError:
+            raise ValueError(
+                f"Specified file_format '{file_format}' is not supported. Use one of "
+                "the following: 'mmcif' or 'pdb'."
+            ) from None
 
         # Get the compressed assembly structure name
-        archive_fn = archive[file_format] % (pdb_code.lower(), int(assembly_num))
+        archive_fn = archive_template % (pdb_code.lower(), int(assembly_num))
 
         if file_format == "mmcif":
-            url = self.pdb_server + "/pub/pdb/data/assemblies/mmCIF/all/%s" % archive_fn
+            url = f"{self.pdb_server}/pub/pdb/data/assemblies/mmCIF/all/{archive_fn}"
         elif file_format == "pdb":
-            url = self.pdb_server + "/pub/pdb/data/biounit/PDB/all/%s" % archive_fn
+            url = f"{self.pdb_server}/pub/pdb/data/biounit/PDB/all/{archive_fn}"
         else:  # better safe than sorry
-            raise ValueError("file_format '%s' not supported: %s" % file_format)
+            raise ValueError(f"file_format '{file_format}' not supported")
 
         # Where will the file be saved?
         if pdir is None:
@@ -561,10 +683,8 @@ class PDBList:
                 path = os.path.join(path, pdb_code[1:3])
         else:  # Put in specified directory
             path = pdir
-        if not os.access(path, os.F_OK):
-            os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
 
-        assembly_gz_file = os.path.join(path, archive_fn)
         assembly_final_file = os.path.join(path, archive_fn[:-3])  # no .gz
 
         # Skip download if the file already exists
@@ -581,15 +701,9 @@ class PDBList:
                 f"'{pdb_code}'..."
             )
         try:
-            urlcleanup()
-            urlretrieve(url, assembly_gz_file)
-        except OSError as err:
+            self._download_gunzipped(url, assembly_final_file)
+        except _DOWNLOAD_ERRORS as err:
             print(f"Download failed! Maybe the desired assembly does not exist: {err}")
-        else:
-            with gzip.open(assembly_gz_file, "rb") as gz:
-                with open(assembly_final_file, "wb") as out:
-                    out.writelines(gz)
-            os.remove(assembly_gz_file)
         return assembly_final_file
 
     def download_all_assemblies(self, listfile=None, file_format=None):
@@ -605,12 +719,19 @@ class PDBList:
         # Deprecation warning
         file_format = self._print_default_format_warning(file_format)
         assemblies = self.get_all_assemblies(file_format)
-        for pdb_code, assembly_num in assemblies:
-            self.retrieve_assembly_file(pdb_code, assembly_num, file_format=file_format)
+        self._map_concurrently(
+            lambda assembly: self.retrieve_assembly_file(
+                *assembly, file_format=file_format
+            ),
+            assemblies,
+        )
         # Write the list
         if listfile:
             with open(listfile, "w") as outfile:
-                outfile.writelines(f"{pdb_code}.{assembly_num}\n" for x in assemblies)
+                outfile.writelines(
+                    f"{pdb_code}.{assembly_num}\n"
+                    for pdb_code, assembly_num in assemblies
+                )
 
     def download_entire_pdb(self, listfile=None, file_format=None):
         """Retrieve all PDB entries not present in the local PDB copy.
@@ -630,9 +751,21 @@ class PDBList:
         """
         # Deprecation warning
         file_format = self._print_default_format_warning(file_format)
+        self._check_file_format(file_format)
         entries = self.get_all_entries()
-        for pdb_code in entries:
-            self.retrieve_pdb_file(pdb_code, file_format=file_format)
+        # Skip the entries already present locally, using a single scan of the
+        # local tree rather than a lookup per entry
+        local_file_names = self._get_local_file_names()
+        final_file_name = _FINAL_FILE_NAMES[file_format]
+        missing = [
+            pdb_code
+            for pdb_code in entries
+            if final_file_name % pdb_code.lower() not in local_file_names
+        ]
+        self._map_concurrently(
+            lambda pdb_code: self.retrieve_pdb_file(pdb_code, file_format=file_format),
+            missing,
+        )
         # Write the list
         if listfile:
             with open(listfile, "w") as outfile:
@@ -652,9 +785,14 @@ class PDBList:
         """
         # Deprecation warning
         file_format = self._print_default_format_warning(file_format)
+        self._check_file_format(file_format)
         entries = self.get_all_obsolete()
-        for pdb_code in entries:
-            self.retrieve_pdb_file(pdb_code, obsolete=True, file_format=file_format)
+        self._map_concurrently(
+            lambda pdb_code: self.retrieve_pdb_file(
+                pdb_code, obsolete=True, file_format=file_format
+            ),
+            entries,
+        )
 
         # Write the list
         if listfile:
@@ -666,7 +804,9 @@ class PDBList:
         if self._verbose:
             print("Retrieving sequence file (takes over 110 MB).")
         url = self.pdb_server + "/pub/pdb/derived_data/pdb_seqres.txt"
-        urlretrieve(url, savefile)
+        with contextlib.closing(urlopen(url)) as handle:
+            with open(savefile, "wb") as out:
+                shutil.copyfileobj(handle, out, _COPY_BUFFER_SIZE)
 
 
 if __name__ == "__main__":
@@ -770,19 +910,20 @@ if __name__ == "__main__":
         elif sys.argv[1][0] == "(":
             # get a set of PDB entries
             pdb_ids = re.findall("[0-9A-Za-z]{4}", sys.argv[1])
-            for pdb_id in pdb_ids:
-                pl.retrieve_pdb_file(
-                    pdb_id, pdir=pdb_path, file_format=file_format, overwrite=overwrite
-                )
-                if with_assemblies:
-                    # PDB Code might have more than one assembly.
-                    assemblies = pl.get_all_assemblies(file_format)
-                    for a_pdb_code, assembly_num in assemblies:
-                        if a_pdb_code == pdb_id:
-                            pl.retrieve_assembly_file(
-                                pdb_id,
-                                assembly_num,
-                                pdir=pdb_path,
-                                file_format=file_format,
-                                overwrite=overwrite,
-                            )
+            pl.download_pdb_files(
+                pdb_ids, pdir=pdb_path, file_format=file_format, overwrite=overwrite
+            )
+            if with_assemblies:
+                # PDB Code might have more than one assembly.
+                assemblies = {}
+                for a_pdb_code, assembly_num in pl.get_all_assemblies(file_format):
+                    assemblies.setdefault(a_pdb_code, []).append(assembly_num)
+                for pdb_id in pdb_ids:
+                    for assembly_num in assemblies.get(pdb_id, []):
+                        pl.retrieve_assembly_file(
+                            pdb_id,
+                            assembly_num,
+                            pdir=pdb_path,
+                            file_format=file_format,
+                            overwrite=overwrite,
+                        )
@@ -0,0 +1,324 @@
+# This file is part of the Biopython distribution and governed by your
+# choice of the "Biopython License Agreement" or the "BSD 3-Clause License".
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Testing Bio.PDB.PDBList against a local file:// mirror of the PDB."""
+
+import contextlib
+import gzip
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.request
+
+# We want to test this module:
+from Bio.PDB.PDBList import PDBList
+
+# run_tests.py --offline replaces urlopen to catch any internet access, so
+# open the local mirror with an opener which only handles file:// URLs
+_open_local = urllib.request.OpenerDirector()
+_open_local.add_handler(urllib.request.FileHandler())
+
+
+class LocalMirrorTestCase(unittest.TestCase):
+    """Base class creating a local mirror and a local PDB tree per test."""
+
+    def setUp(self):
+        patcher = unittest.mock.patch("Bio.PDB.PDBList.urlopen", _open_local.open)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.mirror = os.path.join(self.temp_dir, "mirror")
+        self.local_pdb = os.path.join(self.temp_dir, "local")
+        os.mkdir(self.local_pdb)
+        self.pdblist = PDBList(
+            server=pathlib.Path(self.mirror).as_uri(),
+            pdb=self.local_pdb,
+            verbose=False,
+        )
+
+    def add_remote_file(self, path, data, compress=True):
+        """Write a file in the mirror, gzip compressed by default."""
+        path = os.path.join(self.mirror, *path.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if compress:
+            data = gzip.compress(data)
+        with open(path, "wb") as handle:
+            handle.write(data)
+
+    def add_remote_structure(self, code, data, compress=True):
+        """Write a structure in mmCIF format in the mirror."""
+        self.add_remote_file(
+            f"pub/pdb/data/structures/divided/mmCIF/{code[1:3]}/{code}.cif.gz",
+            data,
+            compress,
+        )
+
+    def retrieve(self, *args, **kwargs):
+        """Call retrieve_pdb_file, capturing what it prints."""
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.pdblist.retrieve_pdb_file(*args, **kwargs)
+
+    def local_files(self):
+        """Return the paths of all files in the local PDB tree."""
+        return sorted(
+            os.path.relpath(os.path.join(path, name), self.local_pdb)
+            for path, dirs, names in os.walk(self.local_pdb)
+            for name in names
+        )
+
+
+class TestRetrievePDBFile(LocalMirrorTestCase):
+    """Test downloading single structures."""
+
+    def test_retrieve(self):
+        """Tests the structure is downloaded and uncompressed."""
+        self.add_remote_structure("1abc", b"data_1ABC\n")
+        filename = self.retrieve("1ABC", file_format="mmCif")
+        self.assertEqual(filename, os.path.join(self.local_pdb, "ab", "1abc.cif"))
+        with open(filename, "rb") as handle:
+            self.assertEqual(handle.read(), b"data_1ABC\n")
+        self.assertEqual(self.local_files(), [os.path.join("ab", "1abc.cif")])
+
+    def test_failed_overwrite_keeps_existing_file(self):
+        """Tests a failed download does not touch an existing copy."""
+        self.add_remote_structure("1abc", b"data_1ABC\n")
+        filename = self.retrieve("1abc", file_format="mmCif")
+        # Truncated transfer of the remote file
+        self.add_remote_structure(
+            "1abc", gzip.compress(b"data_1ABC\n" * 1000)[:-20], compress=False
+        )
+        self.retrieve("1abc", file_format="mmCif", overwrite=True)
+        with open(filename, "rb") as handle:
+            self.assertEqual(handle.read(), b"data_1ABC\n")
+        self.assertEqual(self.local_files(), [os.path.join("ab", "1abc.cif")])
+
+    def test_truncated_download(self):
+        """Tests a truncated transfer leaves no partial file behind."""
+        self.add_remote_structure(
+            "1abc", gzip.compress(b"data_1ABC\n" * 1000)[:-20], compress=False
+        )
+        self.retrieve("1abc", file_format="mmCif")
+        self.assertEqual(self.local_files(), [])
+
+    def test_corrupt_download(self):
+        """Tests corrupt compressed data leaves no partial file behind."""
+        data = bytearray(gzip.compress(bytes(range(256)) * 1000))
+        data[40:60] = b"\xff" * 20
+        self.add_remote_structure("1abc", bytes(data), compress=False)
+        self.retrieve("1abc", file_format="mmCif")
+        self.assertEqual(self.local_files(), [])
+
+    def test_duplicate_codes(self):
+        """Tests downloading the same structure twice concurrently."""
+        self.add_remote_structure("1abc", b"data_1ABC\n" * 10000)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.pdblist.download_pdb_files(
+                ["1abc", "1ABC"], file_format="mmCif", overwrite=True
+            )
+        with open(os.path.join(self.local_pdb, "ab", "1abc.cif"), "rb") as handle:
+            self.assertEqual(handle.read(), b"data_1ABC\n" * 10000)
+        self.assertEqual(self.local_files(), [os.path.join("ab", "1abc.cif")])
+
+
+class TestBulkDownload(LocalMirrorTestCase):
+    """Test downloading several structures in parallel."""
+
+    def test_max_workers(self):
+        """Tests no more than max_workers downloads run at once."""
+        pdblist = PDBList(pdb=self.local_pdb, verbose=False, max_workers=2)
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def retrieve_pdb_file(pdb_code, **kwargs):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return pdb_code
+
+        with unittest.mock.patch.object(
+            pdblist, "retrieve_pdb_file", retrieve_pdb_file
+        ):
+            filenames = pdblist.download_pdb_files(
+                [f"{i}abc" for i in range(10)], file_format="mmCif"
+            )
+        self.assertEqual(filenames, [f"{i}abc" for i in range(10)])
+        self.assertLessEqual(max_running[0], 2)
+
+    def test_items_are_not_all_queued(self):
+        """Tests a long list of entries is not queued all at once."""
+        pdblist = PDBList(pdb=self.local_pdb, verbose=False, max_workers=2)
+        lock = threading.Lock()
+        done = [0]
+        queued = []
+
+        def pdb_codes():
+            for i in range(200):
+                with lock:
+                    # Entries taken from the list but not yet downloaded
+                    queued.append(i - done[0])
+                yield f"{i}abc"
+
+        def retrieve_pdb_file(pdb_code, **kwargs):
+            time.sleep(0.001)
+            with lock:
+                done[0] += 1
+            return pdb_code
+
+        with unittest.mock.patch.object(
+            pdblist, "retrieve_pdb_file", retrieve_pdb_file
+        ):
+            filenames = pdblist.download_pdb_files(pdb_codes(), file_format="mmCif")
+        self.assertEqual(filenames, [f"{i}abc" for i in range(200)])
+        self.assertLessEqual(max(queued), 20)
+
+    def test_failure_does_not_stop_others(self):
+        """Tests an error for one entry does not stop the other downloads."""
+        self.add_remote_structure("1abc", b"data_1ABC\n")
+        self.add_remote_structure("2abc", b"data_2ABC\n")
+        retrieve_pdb_file = self.pdblist.retrieve_pdb_file
+
+        def fail_on_1abc(pdb_code, **kwargs):
+            if pdb_code == "1abc":
+                raise RuntimeError("oops")
+            return retrieve_pdb_file(pdb_code, **kwargs)
+
+        output = io.StringIO()
+        with unittest.mock.patch.object(
+            self.pdblist, "retrieve_pdb_file", fail_on_1abc
+        ), contextlib.redirect_stdout(output):
+            filenames = self.pdblist.download_pdb_files(
+                ["1abc", "2abc"], file_format="mmCif"
+            )
+        self.assertEqual(
+            filenames, [None, os.path.join(self.local_pdb, "ab", "2abc.cif")]
+        )
+        self.assertIn("error 1abc: oops", output.getvalue())
+        self.assertEqual(self.local_files(), [os.path.join("ab", "2abc.cif")])
+
+    def test_download_pdb_files(self):
+        """Tests the list of file names is returned, in order."""
+        self.add_remote_structure("1abc", b"data_1ABC\n")
+        self.add_remote_structure("2xyz", b"data_2XYZ\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            filenames = self.pdblist.download_pdb_files(
+                ["2xyz", "1abc"], file_format="mmCif"
+            )
+        self.assertEqual(
+            filenames,
+            [
+                os.path.join(self.local_pdb, "xy", "2xyz.cif"),
+                os.path.join(self.local_pdb, "ab", "1abc.cif"),
+            ],
+        )
+
+    def test_retrieve_pdb_file_invalid_format(self):
+        """Tests retrieving a structure in an unsupported format."""
+        with self.assertRaises(ValueError):
+            self.pdblist.retrieve_pdb_file("127d", file_format="cif")
+        self.assertEqual(self.local_files(), [])
+
+    def test_retrieve_assembly_file_invalid_format(self):
+        """Tests retrieving an assembly in an unsupported format."""
+        with self.assertRaises(ValueError):
+            self.pdblist.retrieve_assembly_file("127d", "1", file_format="xml")
+        self.assertEqual(self.local_files(), [])
+
+    def test_invalid_format(self):
+        """Tests an invalid file format is rejected before any download."""
+        with unittest.mock.patch.object(
+            self.pdblist, "get_all_entries"
+        ) as get_all_entries:
+            with self.assertRaises(ValueError):
+                self.pdblist.download_entire_pdb(file_format="invalid")
+            get_all_entries.assert_not_called()
+        with self.assertRaises(ValueError):
+            self.pdblist.download_pdb_files(["1abc"], file_format="invalid")
+        self.assertEqual(self.local_files(), [])
+
+
+class TestUpdatePDB(LocalMirrorTestCase):
+    """Test the weekly update of the local PDB tree."""
+
+    def test_assembly_list_failure(self):
+        """Tests structures are updated even if assemblies cannot be listed."""
+        self.add_remote_structure("1abc", b"data_1ABC\n")
+        output = io.StringIO()
+        with unittest.mock.patch.object(
+            self.pdblist, "get_recent_changes", return_value=(["1abc"], [], [])
+        ), unittest.mock.patch.object(
+            self.pdblist, "get_all_assemblies", side_effect=OSError("no FTP")
+        ), contextlib.redirect_stdout(
+            output
+        ):
+            self.pdblist.update_pdb(file_format="mmCif", with_assemblies=True)
+        self.assertIn(
+            "error retrieving the list of assemblies: no FTP", output.getvalue()
+        )
+        self.assertEqual(self.local_files(), [os.path.join("ab", "1abc.cif")])
+
+
+class TestAssemblies(LocalMirrorTestCase):
+    """Test listing and downloading biological assemblies."""
+
+    listing = [
+        "1abc-assembly1.cif.gz",
+        "1abc-assembly2.cif.gz",
+        "2xyz-assembly1.cif.gz",
+        "README.gz",
+        "1abc-assembly1.cif",
+        "index.html",
+    ]
+
+    def setUp(self):
+        super().setUp()
+        # The list of assemblies is fetched with ftplib, not urlopen
+        patcher = unittest.mock.patch("Bio.PDB.PDBList.ftplib.FTP")
+        self.ftp = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.ftp.retrlines.side_effect = lambda cmd, callback: [
+            callback(line) for line in self.listing
+        ]
+
+    def test_get_all_assemblies(self):
+        """Tests names which are not assemblies are skipped."""
+        assemblies = self.pdblist.get_all_assemblies("mmCif")
+        self.assertEqual(assemblies, [("1abc", "1"), ("1abc", "2"), ("2xyz", "1")])
+        self.ftp.cwd.assert_called_once_with("/pub/pdb/data/assemblies/mmCIF/all/")
+
+    def test_download_all_assemblies(self):
+        """Tests all assemblies are downloaded and written to the list file."""
+        for name in self.listing[:3]:
+            self.add_remote_file(
+                f"pub/pdb/data/assemblies/mmCIF/all/{name}", name.encode()
+            )
+        listfile = os.path.join(self.temp_dir, "assemblies.txt")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.pdblist.download_all_assemblies(listfile, file_format="mmCif")
+        with open(listfile) as handle:
+            self.assertEqual(handle.read(), "1abc.1\n1abc.2\n2xyz.1\n")
+        self.assertEqual(
+            self.local_files(),
+            [
+                os.path.join("ab", "1abc-assembly1.cif"),
+                os.path.join("ab", "1abc-assembly2.cif"),
+                os.path.join("xy", "2xyz-assembly1.cif"),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)